@@ -1,15 +1,17 @@
 import os
+import stat
 import time
-import json
 import asyncio
-from collections import defaultdict, deque
-from typing import Dict, Tuple, Deque, List
+from collections import OrderedDict, defaultdict, deque
+from typing import Dict, Tuple, Deque, List, Optional, Set
+from typing import OrderedDict as OrderedDictType
 
 import discord
 from discord.ext import commands
 from discord import app_commands
 
 import aiohttp
+import orjson
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -22,12 +24,17 @@ GUILD_ID = os.getenv("GUILD_ID")
 
 OLLAMA_BASE_URL = "http://localhost:11434"
 OLLAMA_CHAT_ENDPOINT = "/api/chat"
+JSON_HEADERS = {"Content-Type": "application/json"}
 
 MODEL_NAME = os.getenv("OLLAMA_MODEL", "granite3-moe:1b")
 
-MAX_MEMORY_TURNS = 8
+MEMORY_TOKEN_BUDGET = 2048
 MEMORY_EXPIRY_SECONDS = 60 * 60 * 24
+MEMORY_CLEANUP_INTERVAL_SECONDS = 60 * 10
 DISCORD_MESSAGE_LIMIT = 2000
+USER_CACHE_TTL_SECONDS = 60 * 5
+EDIT_INTERVAL_SECONDS = 0.6
+OLLAMA_READ_BUFSIZE = 10 * 1024 * 1024
 
 CHARACTER_DIR = "characters"
 BASE_SYSTEM_FILE = os.path.join(
@@ -46,13 +53,23 @@ intents.message_content = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 
 conversation_memory: Dict[
-    Tuple[int, str], Deque[Dict[str, str]]
-] = defaultdict(lambda: deque(maxlen=MAX_MEMORY_TURNS * 2))
+    Tuple[int, str], Deque[Tuple[str, str, int]]
+] = defaultdict(deque)
 
-last_activity: Dict[Tuple[int, str], float] = {}
+last_activity: OrderedDictType[Tuple[int, str], float] = OrderedDict()
+user_keys: Dict[int, Set[Tuple[int, str]]] = defaultdict(set)
 
-ongoing_generation: Dict[str, bool] = defaultdict(bool)
-user_locks: Dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+active_keys: Set[Tuple[int, str]] = set()
+active_generations: int = 0
+
+_presence: Optional[discord.Status] = None
+
+_char_cache: Dict[str, Tuple[int, str]] = {}
+_sys_cache: Dict[str, Tuple[int, str]] = {}
+_user_cache: Dict[int, Tuple[float, str, str]] = {}
+
+SESSION: Optional[aiohttp.ClientSession] = None
+EXPIRY_TASK: Optional[asyncio.Task] = None
 
 def get_characters() -> List[str]:
     if not os.path.isdir(CHARACTER_DIR):
@@ -73,44 +90,151 @@ def load_base_system_prompt() -> str:
 
 def load_character_prompt(character: str) -> str:
     path = os.path.join(CHARACTER_DIR, f"{character}.txt")
-    if not os.path.isfile(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        _char_cache.pop(character, None)
+        _sys_cache.pop(character, None)
         raise FileNotFoundError(f"Character '{character}' not found.")
+
+    cached = _char_cache.get(character)
+    if cached is not None and cached[0] == st.st_mtime_ns:
+        return cached[1]
+
     with open(path, "r", encoding="utf-8") as f:
-        return f.read().strip()
+        prompt = f.read().strip()
+    _char_cache[character] = (st.st_mtime_ns, prompt)
+    return prompt
+
+
+def load_system_prompt(character: str) -> str:
+    character_prompt = load_character_prompt(character)
+    mtime = _char_cache[character][0]
+
+    cached = _sys_cache.get(character)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    prompt = f"---SYSTEM PROMPT---\n\n{BASE_SYSTEM_PROMPT}\n\n---CHARACTER INFORMATION---\n\n{character_prompt}"
+    _sys_cache[character] = (mtime, prompt)
+    return prompt
 
 
 def cleanup_expired_memory():
     now = time.time()
-    expired = [
-        key for key, ts in last_activity.items()
-        if now - ts > MEMORY_EXPIRY_SECONDS
-    ]
-    for key in expired:
+    while last_activity:
+        key, ts = next(iter(last_activity.items()))
+        if now - ts <= MEMORY_EXPIRY_SECONDS:
+            break
+        last_activity.pop(key)
         conversation_memory.pop(key, None)
+        keys = user_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del user_keys[key[0]]
+
+
+def touch_activity(key: Tuple[int, str]):
+    last_activity[key] = time.time()
+    last_activity.move_to_end(key)
+    user_keys[key[0]].add(key)
+
+
+def clear_user_memory(user_id: int) -> int:
+    cleared = 0
+    for key in user_keys.pop(user_id, ()):
+        if conversation_memory.pop(key, None) is not None:
+            cleared += 1
         last_activity.pop(key, None)
+    return cleared
+
+
+def approx_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def trim_memory(memory: Deque[Tuple[str, str, int]], budget: int):
+    used = sum(tokens for _, _, tokens in memory)
+    while len(memory) > 2 and used > budget:
+        for _ in range(2):
+            used -= memory.popleft()[2]
+
+
+def cleanup_user_cache():
+    now = time.monotonic()
+    expired = [
+        user_id for user_id, (ts, _, _) in _user_cache.items()
+        if now - ts >= USER_CACHE_TTL_SECONDS
+    ]
+    for user_id in expired:
+        _user_cache.pop(user_id, None)
+
+
+async def get_user_names(user_id: int) -> Tuple[str, str]:
+    now = time.monotonic()
+    cached = _user_cache.get(user_id)
+    if cached is not None and now - cached[0] < USER_CACHE_TTL_SECONDS:
+        return cached[1], cached[2]
+
+    user = bot.get_user(user_id) or await bot.fetch_user(user_id)
+    _user_cache[user_id] = (now, user.display_name, user.name)
+    return user.display_name, user.name
+
+
+async def set_presence(status: discord.Status):
+    global _presence
+    if _presence == status:
+        return
+    _presence = status
+    await bot.change_presence(status=status)
+
+
+async def expiry_loop():
+    while True:
+        await asyncio.sleep(MEMORY_CLEANUP_INTERVAL_SECONDS)
+        cleanup_expired_memory()
+        cleanup_user_cache()
 
 
 def split_message(text: str) -> List[str]:
     if len(text) <= DISCORD_MESSAGE_LIMIT:
         return [text]
 
+    paragraphs = text.split("\n")
     chunks = []
-    current = ""
-
-    for paragraph in text.split("\n"):
-        if len(current) + len(paragraph) + 1 > DISCORD_MESSAGE_LIMIT:
-            chunks.append(current)
-            current = paragraph
+    start = 0
+    current_len = 0
+
+    for i, paragraph in enumerate(paragraphs):
+        if i == start:
+            current_len = len(paragraph)
+        elif current_len + len(paragraph) + 1 > DISCORD_MESSAGE_LIMIT:
+            chunk = "\n".join(paragraphs[start:i])
+            if chunk.strip():
+                chunks.append(chunk)
+            start = i
+            current_len = len(paragraph)
         else:
-            if current:
-                current += "\n"
-            current += paragraph
+            current_len += len(paragraph) + 1
 
-    if current:
-        chunks.append(current)
+    last = "\n".join(paragraphs[start:])
+    if last.strip():
+        chunks.append(last)
 
     return chunks
 
+def tail_text(chunks: List[str], limit: int) -> str:
+    size = 0
+    start = len(chunks)
+    while start > 0 and size < limit:
+        start -= 1
+        size += len(chunks[start])
+    return "".join(chunks[start:])[-limit:]
+
+
 async def stream_ollama(model: str, messages: List[Dict[str, str]]):
     payload = {
         "model": model,
@@ -118,33 +242,25 @@ async def stream_ollama(model: str, messages: List[Dict[str, str]]):
         "stream": True,
     }
 
-    buffer = ""
-
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            OLLAMA_BASE_URL + OLLAMA_CHAT_ENDPOINT,
-            json=payload,
-            timeout=None,
-        ) as resp:
-            if resp.status != 200:
-                raise RuntimeError(f"Ollama HTTP {resp.status}")
+    async with SESSION.post(
+        OLLAMA_BASE_URL + OLLAMA_CHAT_ENDPOINT,
+        data=orjson.dumps(payload),
+        headers=JSON_HEADERS,
+    ) as resp:
+        if resp.status != 200:
+            raise RuntimeError(f"Ollama HTTP {resp.status}")
 
-            async for chunk in resp.content.iter_any():
-                buffer += chunk.decode("utf-8")
+        async for line in resp.content:
+            if not line.strip():
+                continue
 
-                while "\n" in buffer:
-                    line, buffer = buffer.split("\n", 1)
-                    line = line.strip()
-                    if not line:
-                        continue
+            data = orjson.loads(line)
 
-                    data = json.loads(line)
+            if data.get("done"):
+                return
 
-                    if data.get("done"):
-                        return
-
-                    if "message" in data and "content" in data["message"]:
-                        yield data["message"]["content"]
+            if "message" in data and "content" in data["message"]:
+                yield data["message"]["content"]
 
 BASE_SYSTEM_PROMPT = load_base_system_prompt()
 
@@ -156,54 +272,79 @@ async def handle_character(
     character: str,
     message: str,
 ):
-    cleanup_expired_memory()
+    global active_generations
 
     key = (user_id, character)
-    last_activity[key] = time.time()
+    touch_activity(key)
 
     try:
-        character_prompt = load_character_prompt(character)
+        system_prompt = load_system_prompt(character)
     except FileNotFoundError as e:
         await send_func(str(e))
         return
 
-    system_prompt = f"---SYSTEM PROMPT---\n\n{BASE_SYSTEM_PROMPT}\n\n---CHARACTER INFORMATION---\n\n{character_prompt}"
-
-    async with user_locks[character]:
-        if ongoing_generation[character]:
-            await send_func(THINKING_MESSAGE)
-            return
+    if key in active_keys:
+        await send_func(THINKING_MESSAGE)
+        return
 
-        ongoing_generation[character] = True
-        await bot.change_presence(status=discord.Status.online)
+    active_keys.add(key)
+    active_generations += 1
+    try:
+        await set_presence(discord.Status.online)
         thinking_msg = await send_func(STARTING_MESSAGE)
         
-        user = await bot.fetch_user(user_id)
+        display_name, name = await get_user_names(user_id)
 
         memory = conversation_memory[key]
         messages = [{"role": "system", "content": system_prompt}]
-        messages.extend(memory)
-        messages.append({"role": "user", "content": f"{user.display_name} (@{user.name}) has asked: {message}.\n\n(to ping the user, use <@{user.id}>)"})
+        messages.extend(
+            {"role": role, "content": content} for role, content, _ in memory
+        )
+        messages.append({"role": "user", "content": f"{display_name} (@{name}) has asked: {message}.\n\n(to ping the user, use <@{user_id}>)"})
+
+        reply_chunks: List[str] = []
+        stream_error = None
+        edit_event = asyncio.Event()
+        finished = asyncio.Event()
+
+        async def edit_worker():
+            while True:
+                await edit_event.wait()
+                edit_event.clear()
+                if finished.is_set():
+                    return
+
+                tail = tail_text(reply_chunks, DISCORD_MESSAGE_LIMIT)
+                if not tail.strip():
+                    continue
 
-        full_reply = ""
-        last_edit = time.monotonic()
+                try:
+                    await edit_func(thinking_msg, tail)
+                except discord.HTTPException as e:
+                    print(f"Failed to update streaming message: {e}")
+
+                try:
+                    await asyncio.wait_for(finished.wait(), EDIT_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+
+        editor = asyncio.create_task(edit_worker())
 
         try:
             async for token in stream_ollama(MODEL_NAME, messages):
-                full_reply += token
+                reply_chunks.append(token)
+                edit_event.set()
+        except Exception as e:
+            stream_error = e
+        finally:
+            finished.set()
+            edit_event.set()
+            await asyncio.gather(editor, return_exceptions=True)
 
-                if time.monotonic() - last_edit > 0.6:
-                    await edit_func(
-                        thinking_msg,
-                        full_reply[-DISCORD_MESSAGE_LIMIT:],
-                    )
-                    last_edit = time.monotonic()
+        full_reply = "".join(reply_chunks)
 
-        except Exception as e:
-            await edit_func(thinking_msg, f"Something went wrong while communicating to ollama: {e}")
-            ongoing_generation[character] = False
-            if not any(ongoing_generation.values()):
-                await bot.change_presence(status=discord.Status.idle)
+        if stream_error is not None:
+            await edit_func(thinking_msg, f"Something went wrong while communicating to ollama: {stream_error}")
             return
 
         if not full_reply.strip():
@@ -211,23 +352,22 @@ async def handle_character(
                 thinking_msg,
                 "The model returned no output.",
             )
-            ongoing_generation[character] = False
-            if not any(ongoing_generation.values()):
-                await bot.change_presence(status=discord.Status.idle)
             return
 
-        memory.append({"role": "user", "content": message})
-        memory.append({"role": "assistant", "content": full_reply})
+        memory.append(("user", message, approx_tokens(message)))
+        memory.append(("assistant", full_reply, approx_tokens(full_reply)))
+        trim_memory(memory, MEMORY_TOKEN_BUDGET)
 
         parts = split_message(full_reply)
 
         await edit_func(thinking_msg, parts[0])
         for part in parts[1:]:
             await send_func(part)
-
-        ongoing_generation[character] = False
-        if not any(ongoing_generation.values()):
-            await bot.change_presence(status=discord.Status.idle)
+    finally:
+        active_keys.discard(key)
+        active_generations -= 1
+        if active_generations == 0:
+            await set_presence(discord.Status.idle)
 
 
 def register_prefix_command(character: str):
@@ -257,14 +397,7 @@ def register_slash_command(character: str):
 
 @bot.command(name="clearmemory")
 async def clear_memory_prefix(ctx: commands.Context):
-    user_id = ctx.author.id
-    keys_to_remove = [key for key in conversation_memory.keys() if key[0] == user_id]
-    
-    for key in keys_to_remove:
-        conversation_memory.pop(key, None)
-        last_activity.pop(key, None)
-    
-    characters_cleared = len(keys_to_remove)
+    characters_cleared = clear_user_memory(ctx.author.id)
     if characters_cleared > 0:
         await ctx.send(f"Cleared your conversation memory for {characters_cleared} character(s).")
     else:
@@ -272,14 +405,7 @@ async def clear_memory_prefix(ctx: commands.Context):
 
 @bot.tree.command(name="clearmemory", description="Clear your conversation memory with all characters")
 async def clear_memory_slash(interaction: discord.Interaction):
-    user_id = interaction.user.id
-    keys_to_remove = [key for key in conversation_memory.keys() if key[0] == user_id]
-    
-    for key in keys_to_remove:
-        conversation_memory.pop(key, None)
-        last_activity.pop(key, None)
-    
-    characters_cleared = len(keys_to_remove)
+    characters_cleared = clear_user_memory(interaction.user.id)
     if characters_cleared > 0:
         await interaction.response.send_message(
             f"Cleared your conversation memory for {characters_cleared} character(s).",
@@ -292,7 +418,15 @@ async def clear_memory_slash(interaction: discord.Interaction):
         )
 
 @bot.event
-async def on_ready():
+async def setup_hook():
+    global SESSION, EXPIRY_TASK
+    SESSION = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=300),
+        timeout=aiohttp.ClientTimeout(total=None, sock_read=None),
+        read_bufsize=OLLAMA_READ_BUFSIZE,
+    )
+    EXPIRY_TASK = asyncio.create_task(expiry_loop())
+
     characters = get_characters()
 
     for character in characters:
@@ -308,9 +442,32 @@ async def on_ready():
     else:
         await bot.tree.sync()
         print("Synced commands globally (may take up to 1 hour)")
-    
-    await bot.change_presence(status=discord.Status.idle)
-    print(f"Logged in as {bot.user}")
+
     print(f"Loaded characters: {', '.join(characters)}")
 
+_bot_close = bot.close
+
+async def close_bot():
+    if EXPIRY_TASK is not None:
+        EXPIRY_TASK.cancel()
+    if SESSION is not None and not SESSION.closed:
+        await SESSION.close()
+    await _bot_close()
+
+bot.close = close_bot
+
+@bot.event
+async def on_ready():
+    global _presence
+    _presence = None
+    await set_presence(discord.Status.idle)
+    print(f"Logged in as {bot.user}")
+
+try:
+    import uvloop
+except ImportError:
+    pass
+else:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
 bot.run(DISCORD_TOKEN)